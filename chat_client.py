@@ -3,24 +3,45 @@
 
 import socket
 import sys
-import pickle
-import struct
+import os
+import selectors
+import bisect
 import threading
+import collections
+import time
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, simpledialog
 import argparse
+import msgspec
+import protocol
 
 DEFAULT_PORT = 8800
 SERVER_HOST = 'localhost'
 
+_DEC = msgspec.msgpack.Decoder(protocol.ServerMessage)
 
-def send_message(channel, *args):
+# Let the kernel wait for a whole header/body (one GIL-free syscall) where supported
+_RECV_FLAGS = getattr(socket, 'MSG_WAITALL', 0)
+
+
+# Last formatted timestamp, reused within the same second
+_last_second = None
+_last_hms = ''
+
+
+def current_hms():
+    """Return the local time as HH:MM:SS, formatting at most once per second."""
+    global _last_second, _last_hms
+    now = int(time.time())
+    if now != _last_second:
+        _last_second = now
+        _last_hms = time.strftime('%H:%M:%S', time.localtime(now))
+    return _last_hms
+
+
+def send_message(channel, message):
     try:
-        buffer = pickle.dumps(args)
-        value = socket.htonl(len(buffer))
-        size = struct.pack("L", value)
-        channel.send(size)
-        channel.send(buffer)
+        channel.sendall(protocol.encode_frame(message))
         return True
     except Exception as e:
         print(f"Error sending: {e}")
@@ -29,18 +50,26 @@ def send_message(channel, *args):
 
 def receive_message(channel):
     try:
-        size_data = channel.recv(struct.calcsize("L"))
-        if not size_data:
+        # Even with MSG_WAITALL a signal can cut the header short, so loop for it too
+        header = bytearray(protocol.HEADER.size)
+        if not protocol.recv_exact(channel, memoryview(header), _RECV_FLAGS):
+            return ''
+        size = protocol.HEADER.unpack(header)[0]
+        buf = bytearray(size)
+        if not protocol.recv_exact(channel, memoryview(buf), _RECV_FLAGS):
             return ''
-        size = socket.ntohl(struct.unpack("L", size_data)[0])
-        buf = b""
-        while len(buf) < size:
-            buf += channel.recv(size - len(buf))
-        return pickle.loads(buf)[0]
+        return _DEC.decode(buf)
     except:
         return ''
 
 
+def configure_tags(text_widget):
+    """Configure the message tags once per text widget."""
+    text_widget.tag_config('system', foreground='blue')
+    text_widget.tag_config('private', foreground='green')
+    text_widget.tag_config('error', foreground='red')
+
+
 class PrivateMessageWindow:
     """Window for private messaging."""
     
@@ -55,6 +84,7 @@ class PrivateMessageWindow:
         self.messages = scrolledtext.ScrolledText(self.window, state='disabled', 
                                                    wrap=tk.WORD, height=20)
         self.messages.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        configure_tags(self.messages)
         
         # Input frame
         input_frame = tk.Frame(self.window)
@@ -76,9 +106,9 @@ class PrivateMessageWindow:
             self.client.send_private_message(self.nickname, message)
             self.input_field.delete(0, tk.END)
     
-    def display_message(self, message):
+    def display_message(self, message, tag=''):
         self.messages.config(state='normal')
-        self.messages.insert(tk.END, message + '\n')
+        self.messages.insert(tk.END, message + '\n', tag)
         self.messages.config(state='disabled')
         self.messages.see(tk.END)
 
@@ -92,7 +122,25 @@ class ChatClientGUI:
         self.connected = False
         self.nickname = ""
         self.private_windows = {}
-        self.users = []
+        self.users = []  # sorted, mirrors the listbox rows
+        self._user_set = set()
+        self._pending = collections.deque()  # (message, tag) waiting for the GUI
+        self._flush_scheduled = False
+        
+        # Server message type -> handler, called from the receive thread
+        self._handlers = {
+            protocol.UserList: lambda msg: self.root.after(0, self.update_user_list, msg.users),
+            protocol.UserJoin: lambda msg: self.root.after(0, self.add_user, msg.nickname),
+            protocol.UserLeave: lambda msg: self.root.after(0, self.remove_user, msg.nickname),
+            protocol.PrivateIn: lambda msg: self.root.after(
+                0, self.handle_incoming_private_message, msg.sender, msg.text),
+            protocol.PrivateOut: lambda msg: self.root.after(
+                0, self.handle_outgoing_private_message, msg.target, msg.text),
+            protocol.OfflineMessage: lambda msg: self.queue_message(msg.text, 'private'),
+            protocol.RateLimited: lambda msg: self.queue_message(msg.text, 'error'),
+            protocol.Error: lambda msg: self.queue_message(msg.text, 'error'),
+            protocol.Public: lambda msg: self.queue_message(msg.text),
+        }
         
         # Create main window
         self.root = tk.Tk()
@@ -167,6 +215,7 @@ class ChatClientGUI:
         self.messages = scrolledtext.ScrolledText(left_frame, state='disabled', 
                                                    wrap=tk.WORD)
         self.messages.pack(padx=10, pady=5, fill=tk.BOTH, expand=True)
+        configure_tags(self.messages)
         
         # Input frame
         input_frame = tk.Frame(left_frame)
@@ -200,6 +249,7 @@ class ChatClientGUI:
     def connect_to_server(self):
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            protocol.tune_socket(self.sock)
             self.sock.connect((self.host, self.port))
             self.connected = True
             
@@ -208,9 +258,8 @@ class ChatClientGUI:
             
             # Receive confirmation
             data = receive_message(self.sock)
-            if data and data.startswith('CLIENT: '):
-                assigned_nick = data.split('CLIENT: ')[1]
-                self.nickname = assigned_nick
+            if isinstance(data, protocol.ClientName):
+                self.nickname = data.nickname
                 self.root.title(f"Chat Client - {self.nickname}")
                 self.status_bar.config(text=f"Connected as {self.nickname}")
                 self.display_message(f"Connected to server as {self.nickname}\n", 'system')
@@ -223,12 +272,27 @@ class ChatClientGUI:
         """Display message in main chat."""
         self.messages.config(state='normal')
         self.messages.insert(tk.END, message + '\n', tag)
-        
-        # Configure tags
-        self.messages.tag_config('system', foreground='blue')
-        self.messages.tag_config('private', foreground='green')
-        self.messages.tag_config('error', foreground='red')
-        
+        self.messages.config(state='disabled')
+        self.messages.see(tk.END)
+    
+    def queue_message(self, message, tag=''):
+        """Queue message for the main chat; safe to call from the receive thread."""
+        self._pending.append((message, tag))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.root.after_idle(self._flush_pending)
+    
+    def _flush_pending(self):
+        """Insert all queued messages in a single widget update."""
+        self._flush_scheduled = False
+        chunks = []
+        while self._pending:
+            message, tag = self._pending.popleft()
+            chunks += (message + '\n', tag)
+        if not chunks:
+            return
+        self.messages.config(state='normal')
+        self.messages.insert(tk.END, *chunks)
         self.messages.config(state='disabled')
         self.messages.see(tk.END)
     
@@ -248,9 +312,7 @@ class ChatClientGUI:
             else:
                 # Public message - display it immediately for the sender
                 if send_message(self.sock, message):
-                    import datetime
-                    timestamp = datetime.datetime.now().strftime('%H:%M:%S')
-                    self.display_message(f"[{timestamp}] YOU: {message}")
+                    self.display_message(f"[{current_hms()}] YOU: {message}")
                     self.input_field.delete(0, tk.END)
     
     def send_private_message(self, target, message):
@@ -276,11 +338,30 @@ class ChatClientGUI:
                 self.private_windows[nickname].window.lift()
     
     def update_user_list(self, users):
-        """Update the user list."""
-        self.users = users
-        self.user_listbox.delete(0, tk.END)
-        for user in sorted(users):
-            self.user_listbox.insert(tk.END, user)
+        """Update the user list, touching only the rows that changed."""
+        new_set = set(users)
+        for user in self._user_set - new_set:
+            self.remove_user(user)
+        for user in new_set - self._user_set:
+            self.add_user(user)
+    
+    def add_user(self, user):
+        """Insert user at its sorted position."""
+        if user in self._user_set:
+            return
+        idx = bisect.bisect_left(self.users, user)
+        self.users.insert(idx, user)
+        self._user_set.add(user)
+        self.user_listbox.insert(idx, user)
+    
+    def remove_user(self, user):
+        """Remove user's row."""
+        if user not in self._user_set:
+            return
+        idx = bisect.bisect_left(self.users, user)
+        del self.users[idx]
+        self._user_set.discard(user)
+        self.user_listbox.delete(idx)
     
     def receive_messages(self):
         """Receive messages from server."""
@@ -290,61 +371,14 @@ class ChatClientGUI:
                 
                 if not data:
                     self.connected = False
-                    self.root.after(0, lambda: self.display_message(
-                        "Disconnected from server", 'error'))
+                    self.queue_message("Disconnected from server", 'error')
                     self.root.after(0, lambda: self.status_bar.config(
                         text="Disconnected"))
                     break
                 
-                # Handle user list update
-                if data.startswith('USERLIST:'):
-                    users = data.split('USERLIST:')[1].split(',')
-                    users = [u.strip() for u in users if u.strip()]
-                    self.root.after(0, lambda u=users: self.update_user_list(u))
-                    continue
-                
-                # Handle private messages display in private window
-                if 'PRIVATE' in data:
-                    if 'PRIVATE from' in data:
-                        parts = data.split('PRIVATE from ')
-                        if len(parts) > 1:
-                            sender_part = parts[1].split(':', 1)
-                            if len(sender_part) > 1:
-                                sender = sender_part[0].strip()
-                                
-                                # Create window and display message together
-                                self.root.after(0, lambda s=sender, d=data: 
-                                    self.handle_incoming_private_message(s, d))
-                        continue  
-                    
-                    # Outgoing private message confirmation (sent by this user)
-                    elif 'PRIVATE to' in data:
-                        parts = data.split('PRIVATE to ')
-                        if len(parts) > 1:
-                            target_part = parts[1].split(':', 1)
-                            if len(target_part) > 1:
-                                target = target_part[0].strip()
-                                
-                                # Create window and display message together
-                                self.root.after(0, lambda t=target, d=data: 
-                                    self.handle_outgoing_private_message(t, d))
-                        continue  
-                    
-                    # Offline message or other private message notification
-                    # Display in main window for system notifications
-                    if 'OFFLINE MESSAGE' in data or 'is offline' in data:
-                        self.root.after(0, lambda d=data: 
-                            self.display_message(d, 'private'))
-                        continue
-                
-                # Handle rate limit warningg
-                elif data.startswith('RATE_LIMIT:'):
-                    self.root.after(0, lambda d=data: 
-                        self.display_message(d, 'error'))
-                
-                # Regular public message display in main window
-                else:
-                    self.root.after(0, lambda d=data: self.display_message(d))
+                handler = self._handlers.get(type(data))
+                if handler:
+                    handler(data)
                 
             except Exception as e:
                 if self.connected:
@@ -393,9 +427,11 @@ class ChatClientConsole:
         self.port = port
         self.connected = False
         self.sock = None
+        self.input_buf = b''  # partial stdin line
         
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            protocol.tune_socket(self.sock)
             self.sock.connect((host, port))
             print(f"Connected to {host}:{port}")
             self.connected = True
@@ -403,8 +439,8 @@ class ChatClientConsole:
             send_message(self.sock, f'NAME: {name}')
             data = receive_message(self.sock)
             
-            if data and data.startswith('CLIENT: '):
-                self.name = data.split('CLIENT: ')[1]
+            if isinstance(data, protocol.ClientName):
+                self.name = data.nickname
                 print(f"Connected as: {self.name}")
             
             print("\nCommands:")
@@ -416,56 +452,70 @@ class ChatClientConsole:
             sys.exit(1)
     
     def run(self):
-        """Main client loop."""
-        input_thread = threading.Thread(target=self.handle_input, daemon=True)
-        input_thread.start()
+        """Main client loop: wait on the server socket and stdin in one thread."""
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ, self.handle_server)
+        sel.register(sys.stdin, selectors.EVENT_READ, self.handle_input)
+        self.show_prompt()
         
         try:
             while self.connected:
-                data = receive_message(self.sock)
-                
-                if not data:
-                    print("\nDisconnected from server")
-                    self.connected = False
-                    break
-                
-                if data.startswith('USERLIST:'):
-                    # Dont print user list in console mode
-                    continue
-                
-                print(f"\n{data}")
-                sys.stdout.write(f"[{self.name}]> ")
-                sys.stdout.flush()
+                for key, _ in sel.select():
+                    key.data()
+                    if not self.connected:
+                        break
         except KeyboardInterrupt:
             print("\nExiting...")
         except Exception as e:
             print(f"\nError: {e}")
         finally:
+            sel.close()
             self.cleanup()
     
+    def show_prompt(self):
+        sys.stdout.write(f"[{self.name}]> ")
+        sys.stdout.flush()
+    
+    def handle_server(self):
+        """Print one message from the server."""
+        data = receive_message(self.sock)
+        
+        if not data:
+            print("\nDisconnected from server")
+            self.connected = False
+            return
+        
+        if isinstance(data, (protocol.UserList, protocol.UserJoin, protocol.UserLeave)):
+            # Dont print user list in console mode
+            return
+        
+        # Every other message carries its display line in .text
+        print(f"\n{data.text}")
+        self.show_prompt()
+    
     def handle_input(self):
-        """Handle user input."""
-        while self.connected:
-            try:
-                sys.stdout.write(f"[{self.name}]> ")
-                sys.stdout.flush()
-                line = sys.stdin.readline().strip()
-                
-                if not line:
-                    continue
-                
-                if line.lower() in ['/quit', '/exit']:
-                    print("\nLeaving chat...")
-                    self.connected = False
-                    break
-                
-                if not send_message(self.sock, line):
-                    self.connected = False
-                    break
-            except Exception as e:
-                print(f"\nInput error: {e}")
+        """Handle user input that is ready on stdin."""
+        chunk = os.read(sys.stdin.fileno(), 4096)
+        if not chunk:
+            # stdin closed
+            self.connected = False
+            return
+        
+        # Several lines may arrive in one read (e.g. pasted text)
+        *lines, self.input_buf = (self.input_buf + chunk).split(b'\n')
+        for raw in lines:
+            line = raw.decode('utf-8', errors='replace').strip()
+            
+            if line.lower() in ['/quit', '/exit']:
+                print("\nLeaving chat...")
                 self.connected = False
-                break
+                return
+            
+            if line and not send_message(self.sock, line):
+                self.connected = False
+                return
+            
+            self.show_prompt()
     
     def cleanup(self):
         """Close connection."""
@@ -5,55 +5,148 @@ Optional relay server that prepends '*' to nicknames
 """
 
 import socket
-import select
 import sys
 import signal
-import pickle
-import struct
 import argparse
+import asyncio
 import threading
-import datetime
+import queue
+import time
+import gc
+import contextlib
+import multiprocessing
+import msgspec
+import protocol
 
 DEFAULT_RELAY_PORT = 8900
 DEFAULT_SERVER_PORT = 8800
 SERVER_HOST = 'localhost'
 LOG_FILE = 'relay_log.txt'
+SCRATCH_SIZE = 4096  # initial per-socket receive buffer
+LOG_QUEUE_SIZE = 10000  # pending log entries before new ones are dropped
+LOG_SCAN_LIMIT = 512  # relayed frames this large are never short enough to log
+STATS_INTERVAL = 30  # seconds
+WORKER_STATS_FIELDS = 3  # active connections, messages relayed, dropped log entries
 
+# Relayed frames are decoded against the shared protocol schemas
+_DEC = msgspec.msgpack.Decoder(protocol.Message)
+_HDR = protocol.HEADER
 
-def log_message(message):
-    """Write message to relay log file with timestamp."""
+
+@contextlib.contextmanager
+def _no_gc():
+    """Suspend the cyclic GC while a burst of frames is processed."""
+    enabled = gc.isenabled()
+    gc.disable()
     try:
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with open(LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(f"[{timestamp}] {message}\n")
-    except Exception as e:
-        print(f"Error logging: {e}")
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 
-def send_message(channel, *args):
-    try:
-        buffer = pickle.dumps(args)
-        value = socket.htonl(len(buffer))
-        size = struct.pack("L", value)
-        channel.send(size)
-        channel.send(buffer)
-        return True
-    except Exception as e:
-        return False
+def log_text(message):
+    """Readable form of a relayed message, as the old string protocol spelled it."""
+    if isinstance(message, str):
+        return message
+    if isinstance(message, protocol.ClientName):
+        return f"CLIENT: {message.nickname}"
+    if isinstance(message, protocol.UserList):
+        return f"USERLIST:{','.join(message.users)}"
+    if isinstance(message, protocol.UserJoin):
+        return f"USERJOIN: {message.nickname}"
+    if isinstance(message, protocol.UserLeave):
+        return f"USERLEAVE: {message.nickname}"
+    return message.text
 
 
-def receive_message(channel):
-    try:
-        size_data = channel.recv(struct.calcsize("L"))
-        if not size_data:
-            return ''
-        size = socket.ntohl(struct.unpack("L", size_data)[0])
-        buf = b""
-        while len(buf) < size:
-            buf += channel.recv(size - len(buf))
-        return pickle.loads(buf)[0]
-    except:
-        return ''
+class RelayProtocol(asyncio.BufferedProtocol):
+    """
+    One side of a relayed pair. Received bytes land directly in a reusable
+    scratch buffer; every complete frame is forwarded to the peer side.
+    """
+    
+    def __init__(self, relay, direction, rewrite_first, client_addr=None, peer=None):
+        self.relay = relay
+        self.direction = direction
+        self.first_message = rewrite_first
+        self.client_addr = client_addr
+        self.peer = peer  # RelayProtocol of the other side
+        self.transport = None
+        self.scratch = bytearray(SCRATCH_SIZE)
+        self.filled = 0  # bytes of scratch holding unprocessed data
+        self.needed = 0  # total size of the frame currently being received
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        protocol.tune_socket(transport.get_extra_info('socket'))
+        if self.peer is None:
+            # Client side: hold its data until the server side is connected
+            self.client_addr = transport.get_extra_info('peername')
+            transport.pause_reading()
+            asyncio.ensure_future(self.relay.handle_client_connection(self))
+    
+    def get_buffer(self, sizehint):
+        scratch = self.scratch
+        if self.needed > len(scratch):
+            scratch.extend(b'\0' * (self.needed - len(scratch)))
+        elif self.relay.buffer_relax and not self.filled and len(scratch) > SCRATCH_SIZE:
+            del scratch[SCRATCH_SIZE:]
+        return memoryview(scratch)[self.filled:]
+    
+    def buffer_updated(self, nbytes):
+        scratch = self.scratch
+        self.filled += nbytes
+        off = 0
+        start = 0  # first byte not yet written to the peer
+        spliced = 0
+        self.needed = 0
+        try:
+            with _no_gc(), memoryview(scratch) as view:
+                while self.filled - off >= _HDR.size:
+                    size = _HDR.unpack_from(scratch, off)[0]
+                    end = off + _HDR.size + size
+                    if end > self.filled:
+                        self.needed = end - off
+                        break
+                    if self.first_message:
+                        # Only the first client message is decoded, to rewrite the nickname
+                        data = _DEC.decode(view[off + _HDR.size:end])
+                        self.relay.forward_data(self, data)
+                        start = end
+                    else:
+                        if size < LOG_SCAN_LIMIT:
+                            self.relay.log_message(bytes(view[off + _HDR.size:end]), self.direction)
+                        spliced += 1
+                    off = end
+        except Exception as e:
+            print(f"Forward error ({self.direction}): {e}")
+            self.transport.close()
+            return
+        
+        # Pass every other complete frame through verbatim in one write
+        if start < off:
+            self.peer.transport.write(scratch[start:off])
+            self.relay.total_relayed += spliced
+        
+        # Move the partial frame, if any, to the front of the buffer
+        if off:
+            self.filled -= off
+            scratch[:self.filled] = scratch[off:off + self.filled]
+    
+    def pause_writing(self):
+        # Our outgoing buffer is full: stop reading from the side that fills it
+        if self.peer and self.peer.transport:
+            self.peer.transport.pause_reading()
+    
+    def resume_writing(self):
+        if self.peer and self.peer.transport:
+            self.peer.transport.resume_reading()
+    
+    def connection_lost(self, exc):
+        print(f"Connection closed: {self.client_addr} ({self.direction})")
+        self.relay.log_message(f"Connection closed: {self.client_addr} ({self.direction})")
+        self.relay.cleanup_connection(self)
 
 
 class ChatRelay:
@@ -62,62 +155,151 @@ class ChatRelay:
     that appends '*' to the user's nickname. 
     """
     
-    def __init__(self, relay_port, server_host, server_port, backlog=5):
-        """Initialize relay server."""
+    def __init__(self, relay_port, server_host, server_port, backlog=5, buffer_relax=False,
+                 workers=1, worker=None):
+        """
+        Initialize relay server.
+        
+        With workers > 1 this process only supervises: every worker process binds
+        the relay port with SO_REUSEPORT and runs its own event loop. worker is the
+        (index, log queue, shared stats) tuple such a worker process is started with.
+        """
         self.relay_port = relay_port
         self.server_host = server_host
         self.server_port = server_port
+        self.server_addr = None  # resolved (ip, port) of the main server
+        self.backlog = backlog
+        self.buffer_relax = buffer_relax  # shrink receive buffers after oversized messages
         self.relay_socket = None
+        self.server = None  # asyncio server wrapping relay_socket
         self.running = False
-        self.connections = {}  # client_socket -> server_socket
+        self.connections = {}  # RelayProtocol -> peer RelayProtocol
         self.total_relayed = 0
+        self._logf = None
+        self._log_thread = None
+        self._dropped_logs = 0
+        
+        if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            print("SO_REUSEPORT is not available, running a single relay process")
+            workers = 1
+        self.workers = workers
+        self.worker = worker
+        self.processes = []
+        
+        if worker is not None:
+            self.worker_index, self._log_q, self._worker_stats = worker
+        elif workers > 1:
+            ctx = multiprocessing.get_context('spawn')
+            self._log_q = ctx.Queue(LOG_QUEUE_SIZE)
+            self._worker_stats = ctx.Array('q', WORKER_STATS_FIELDS * workers, lock=False)
+        else:
+            self._log_q = queue.Queue(LOG_QUEUE_SIZE)  # (time, direction, message)
+            self._worker_stats = None
         
         try:
-            self.relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.relay_socket.bind(('0.0.0.0', relay_port))
-            self.relay_socket.listen(backlog)
+            # Resolve the main server once instead of on every client connection
+            self.server_addr = socket.getaddrinfo(server_host, server_port,
+                                                  socket.AF_INET, socket.SOCK_STREAM)[0][-1]
             
-            print(f"Chat Relay listening on port {relay_port}")
-            print(f"Forwarding to {server_host}:{server_port}")
-            log_message(f"Relay started: port {relay_port} -> {server_host}:{server_port}")
+            if worker is None:
+                # Log writes happen on a background thread that owns the file
+                self._logf = open(LOG_FILE, 'a', encoding='utf-8', buffering=8192)
+                self._log_thread = threading.Thread(target=self._log_worker, daemon=True)
+                self._log_thread.start()
             
-            signal.signal(signal.SIGINT, self.shutdown)
+            if workers == 1:
+                self.relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if worker is not None:
+                    self.relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                self.relay_socket.bind(('0.0.0.0', relay_port))
+                self.relay_socket.listen(backlog)
+            
+            if worker is None:
+                print(f"Chat Relay listening on port {relay_port}")
+                print(f"Forwarding to {server_host}:{server_port}")
+                self.log_message(f"Relay started: port {relay_port} -> {server_host}:{server_port}")
+            else:
+                # The supervising process decides when workers stop (SIGTERM, see _serve)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+            
+            # Startup objects live forever; keep them out of future GC passes
+            gc.freeze()
         except Exception as e:
             print(f"Error starting relay: {e}")
             sys.exit(1)
     
-    def shutdown(self, signum=None, frame=None):
-        """Clean shutdown."""
-        print("\nshutting down relay...")
+    def stop(self):
+        """Signal callback on the event loop: stop accepting and drop every relay pair."""
+        if self.worker is None:
+            print("\nshutting down relay...")
+        self.running = False
+        if self.server:
+            self.server.close()
+        for side in list(self.connections):
+            side.transport.close()
+    
+    def shutdown(self):
+        """Clean shutdown, once serving has stopped."""
         self.running = False
         
-        # Close all connections
-        for client_sock, server_sock in list(self.connections.items()):
-            try:
-                client_sock.close()
-            except:
-                pass
-            try:
-                server_sock.close()
-            except:
-                pass
+        # Stop worker processes
+        for proc in self.processes:
+            proc.terminate()
+        for proc in self.processes:
+            proc.join(timeout=5)
         
-        if self.relay_socket:
+        # The asyncio server closes the listening socket itself
+        if self.server is None and self.relay_socket:
             try:
                 self.relay_socket.close()
             except:
                 pass
         
-        log_message("Relay shut down")
-        sys.exit(0)
+        if self._log_thread:
+            self.log_message("Relay shut down")
+            self._log_q.put(None)
+            self._log_thread.join(timeout=5)
+    
+    def log_message(self, message, direction=None):
+        """Queue message for the relay log; never blocks the caller."""
+        try:
+            self._log_q.put_nowait((time.time(), direction, message))
+        except queue.Full:
+            self._dropped_logs += 1
     
-    def connect_to_server(self):
-        """Create connection to main chat server."""
+    def _log_worker(self):
+        """Write queued log entries with timestamps, flushing when idle."""
+        while True:
+            entry = self._log_q.get()
+            if entry is None:
+                break
+            logged_at, direction, message = entry
+            try:
+                if direction is not None:
+                    if isinstance(message, bytes):
+                        message = _DEC.decode(message)
+                    message = log_text(message)
+                    if len(message) >= 100:  # Only log short relayed messages
+                        continue
+                    message = f"{direction}: {message}"
+                timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(logged_at))
+                self._logf.write(f"[{timestamp}] {message}\n")
+                if self._log_q.empty():
+                    self._logf.flush()
+            except Exception as e:
+                print(f"Error logging: {e}")
+        self._logf.close()
+    
+    async def connect_to_server(self, client_side):
+        """Create connection to main chat server for client_side."""
         try:
-            server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_sock.connect((self.server_host, self.server_port))
-            return server_sock
+            loop = asyncio.get_running_loop()
+            _, server_side = await loop.create_connection(
+                lambda: RelayProtocol(self, "Server->Client", False,
+                                      client_side.client_addr, client_side),
+                *self.server_addr)
+            return server_side
         except Exception as e:
             print(f"Error connecting to server: {e}")
             return None
@@ -130,138 +312,163 @@ class ChatRelay:
                 return f'NAME: *{nickname}'
         return data
     
-    def handle_client_connection(self, client_sock, client_addr):
+    async def handle_client_connection(self, client_side):
+        client_addr = client_side.client_addr
         print(f"New client connection from {client_addr}")
-        log_message(f"Client connected: {client_addr}")
+        self.log_message(f"Client connected: {client_addr}")
         
         # Connect to main server
-        server_sock = self.connect_to_server()
-        if not server_sock:
+        server_side = await self.connect_to_server(client_side)
+        if not server_side:
             print(f"Failed to connect to server for client {client_addr}")
-            client_sock.close()
+            client_side.transport.close()
+            return
+        if client_side.transport.is_closing():
+            server_side.transport.close()
             return
         
         # Store connection pair
-        self.connections[client_sock] = server_sock
-        self.connections[server_sock] = client_sock
+        client_side.peer = server_side
+        self.connections[client_side] = server_side
+        self.connections[server_side] = client_side
         
         print(f"Relay established for {client_addr}")
-        log_message(f"Relay established: {client_addr} <-> {self.server_host}:{self.server_port}")
-        
-        # Start bidirectional forwarding
-        client_thread = threading.Thread(
-            target=self.forward_data,
-            args=(client_sock, server_sock, True, client_addr),
-            daemon=True
-        )
-        server_thread = threading.Thread(
-            target=self.forward_data,
-            args=(server_sock, client_sock, False, client_addr),
-            daemon=True
-        )
+        self.log_message(f"Relay established: {client_addr} <-> {self.server_host}:{self.server_port}")
         
-        client_thread.start()
-        server_thread.start()
+        # Start forwarding client data
+        client_side.transport.resume_reading()
     
-    def forward_data(self, source_sock, dest_sock, is_client_to_server, client_addr):
-        """Forward data between client and server."""
-        direction = "Client->Server" if is_client_to_server else "Server->Client"
-        first_message = True
+    def forward_data(self, source, data):
+        """Forward one message from source to its peer."""
+        # Rewrite nickname on first client message
+        if source.first_message:
+            if isinstance(data, str) and data.startswith('NAME: '):
+                original_data = data
+                data = self.rewrite_nickname(data)
+                print(f"Rewrote nickname: {original_data} -> {data}")
+                self.log_message(f"Nickname rewrite: {original_data} -> {data}")
+            source.first_message = False
         
-        try:
-            while self.running:
-                data = receive_message(source_sock)
-                
-                if not data:
-                    # Connection closed
-                    print(f"Connection closed: {client_addr} ({direction})")
-                    log_message(f"Connection closed: {client_addr} ({direction})")
-                    break
-                
-                # Rewrite nickname on first client message
-                if is_client_to_server and first_message:
-                    if data.startswith('NAME: '):
-                        original_data = data
-                        data = self.rewrite_nickname(data)
-                        print(f"Rewrote nickname: {original_data} -> {data}")
-                        log_message(f"Nickname rewrite: {original_data} -> {data}")
-                    first_message = False
-                
-                # Forward the message
-                if not send_message(dest_sock, data):
-                    break
-                
-                self.total_relayed += 1
-                
-                # Log relayed traffic 
-                if len(data) < 100:  # Only log short messages
-                    log_message(f"{direction}: {data}")
+        # Forward the message
+        source.peer.transport.write(protocol.encode_frame(data))
         
-        except Exception as e:
-            print(f"Forward error ({direction}): {e}")
-        finally:
-            # Clean up both sockets
-            self.cleanup_connection(source_sock, dest_sock, client_addr)
+        self.total_relayed += 1
+        
+        # Log relayed traffic 
+        self.log_message(data, source.direction)
     
-    def cleanup_connection(self, sock1, sock2, client_addr):
+    def cleanup_connection(self, side):
         """Clean up connection pair."""
         try:
-            if sock1 in self.connections:
-                del self.connections[sock1]
-            if sock2 in self.connections:
-                del self.connections[sock2]
+            peer = self.connections.pop(side, None)
+            if peer is None:
+                return  # Already cleaned up by the other side
+            self.connections.pop(peer, None)
             
-            sock1.close()
-            sock2.close()
+            side.transport.close()
+            peer.transport.close()
             
-            print(f"Cleaned up relay for {client_addr}")
-            log_message(f"Relay cleaned up: {client_addr}")
+            print(f"Cleaned up relay for {side.client_addr}")
+            self.log_message(f"Relay cleaned up: {side.client_addr}")
         except:
             pass
     
+    def stats_snapshot(self):
+        """Return (active connections, messages relayed, dropped log entries)."""
+        if self.processes:
+            stats = self._worker_stats
+            active, relayed, dropped = (sum(stats[i::WORKER_STATS_FIELDS])
+                                        for i in range(WORKER_STATS_FIELDS))
+            return active, relayed, dropped + self._dropped_logs
+        active_connections = len(self.connections) // 2  # Divide by 2 as we store both directions
+        return active_connections, self.total_relayed, self._dropped_logs
+    
     def print_stats(self):
-        """Print periodic statistics."""
+        """Print current statistics."""
+        active_connections, total_relayed, dropped_logs = self.stats_snapshot()
+        print(f"\n=== Relay Stats ===")
+        print(f"Active Connections: {active_connections}")
+        print(f"Total Messages Relayed: {total_relayed}")
+        print(f"Dropped Log Entries: {dropped_logs}")
+        print(f"===================\n")
+    
+    async def _stats_loop(self):
+        """Print stats periodically; workers publish theirs to the supervisor instead."""
+        while self.running:
+            if self.worker is None:
+                await asyncio.sleep(STATS_INTERVAL)
+                self.print_stats()
+            else:
+                await asyncio.sleep(1)
+                base = self.worker_index * WORKER_STATS_FIELDS
+                self._worker_stats[base:base + WORKER_STATS_FIELDS] = self.stats_snapshot()
+    
+    async def _serve(self):
+        """Accept clients and relay them on a single event loop."""
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: RelayProtocol(self, "Client->Server", True), sock=self.relay_socket)
+        
+        # Handle the stop signal as a loop callback, never inside a frame handler
+        # (log_message takes the log queue's lock)
+        loop.add_signal_handler(signal.SIGTERM if self.worker else signal.SIGINT, self.stop)
+        
+        # Start stats task
+        stats_task = asyncio.create_task(self._stats_loop())
+        
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass  # stop() closed the server
+        finally:
+            stats_task.cancel()
+    
+    def _supervise(self):
+        """Start the worker processes and print their combined statistics."""
+        ctx = multiprocessing.get_context('spawn')
+        for index in range(self.workers):
+            proc = ctx.Process(
+                target=ChatRelay._worker_run,
+                args=(index, self.relay_port, self.server_host, self.server_port,
+                      self.backlog, self.buffer_relax, self._log_q, self._worker_stats),
+                daemon=True
+            )
+            proc.start()
+            self.processes.append(proc)
+        
+        print(f"Relay running with {self.workers} worker processes. Press Ctrl+C to stop.\n")
+        
         while self.running:
-            import time
-            time.sleep(30)
-            active_connections = len(self.connections) // 2  # Divide by 2 as we store both directions
-            print(f"\n=== Relay Stats ===")
-            print(f"Active Connections: {active_connections}")
-            print(f"Total Messages Relayed: {self.total_relayed}")
-            print(f"===================\n")
+            time.sleep(STATS_INTERVAL)
+            self.print_stats()
+    
+    @classmethod
+    def _worker_run(cls, index, relay_port, server_host, server_port, backlog, buffer_relax,
+                    log_q, worker_stats):
+        """Entry point of a worker process."""
+        relay = cls(relay_port, server_host, server_port, backlog, buffer_relax,
+                    worker=(index, log_q, worker_stats))
+        relay.run()
     
     def run(self):
         """Main relay loop."""
         self.running = True
         
-        print("Relay running. Press Ctrl+C to stop.\n")
-        
-        # Start stats thread
-        stats_thread = threading.Thread(target=self.print_stats, daemon=True)
-        stats_thread.start()
+        try:
+            if self.workers > 1:
+                # Ctrl+C arrives as KeyboardInterrupt while the supervisor sleeps
+                self._supervise()
+            else:
+                if self.worker is None:
+                    print("Relay running. Press Ctrl+C to stop.\n")
+                asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            print("\nshutting down relay...")
+        except Exception as e:
+            print(f"Error: {e}")
         
-        while self.running:
-            try:
-                # Accept client connections
-                readable, _, _ = select.select([self.relay_socket], [], [], 1)
-                
-                for sock in readable:
-                    client_sock, client_addr = sock.accept()
-                    
-                    # Handle in new thread
-                    handler = threading.Thread(
-                        target=self.handle_client_connection,
-                        args=(client_sock, client_addr),
-                        daemon=True
-                    )
-                    handler.start()
-            
-            except select.error as e:
-                print(f"Select error: {e}")
-                break
-            except Exception as e:
-                print(f"Error: {e}")
-                break
+        self.shutdown()
 
 
 def main():
@@ -273,9 +480,14 @@ def main():
                         help=f'Main server host (default: {SERVER_HOST})')
     parser.add_argument('--server-port', type=int, default=DEFAULT_SERVER_PORT,
                         help=f'Main server port (default: {DEFAULT_SERVER_PORT})')
+    parser.add_argument('--buffer-relax', action='store_true',
+                        help='Shrink receive buffers back after oversized messages')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of relay worker processes (default: 1)')
     args = parser.parse_args()
     
-    relay = ChatRelay(args.relay_port, args.server_host, args.server_port)
+    relay = ChatRelay(args.relay_port, args.server_host, args.server_port,
+                      buffer_relax=args.buffer_relax, workers=args.workers)
     relay.run()
 
 
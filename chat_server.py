@@ -2,23 +2,33 @@
 """Chat Server -  Chat Project"""
 
 import socket
-import select
+import selectors
 import sys
 import signal
-import pickle
-import struct
 import argparse
 import threading
 import datetime
 import time
-import json
+import collections
+import gzip
 import random
 import string
 import os
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import re
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from io import BytesIO
 import asyncio
 import websockets
+import msgspec
+
+# Optional: faster event loop for the WebSocket server
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from protocol import (HEADER, tune_socket, encode_frame, recv_exact, ClientName, UserList, UserJoin, UserLeave, PrivateIn, PrivateOut,
+                      OfflineMessage, RateLimited, Error, Public)
 
 # Configuration
 DEFAULT_CHAT_PORT = 8800
@@ -26,68 +36,135 @@ DEFAULT_HTTP_PORT = 8080
 DEFAULT_WS_PORT = 8081
 SERVER_HOST = '0.0.0.0'
 LOG_FILE = 'chat_log.txt'
+LOG_FLUSH_INTERVAL = 1  # seconds
+GZIP_LEVEL = 6  # /api/messages compression; 9 costs much more CPU for little gain
 MESSAGE_RATE_LIMIT = 10  # messages per minute
 RATE_LIMIT_WINDOW = 60  # seconds
+WS_QUEUE_SIZE = 2000  # pending messages per websocket client; must exceed MAX_BUFFER_SIZE
+
+# Clients only send strings
+_DEC = msgspec.msgpack.Decoder(str)
+
+# JSON for the HTTP API; encodes straight to bytes
+_JSON_ENC = msgspec.json.Encoder()
+
+# Live counters substituted into chat_monitor.html on every request
+HTML_PLACEHOLDERS = re.compile(r'({{CLIENT_COUNT}}|{{MESSAGE_COUNT}}|{{PRIVATE_COUNT}})')
 
 # Global message buffer for web interface
-message_buffer = []
 MAX_BUFFER_SIZE = 1000
+message_buffer = collections.deque(maxlen=MAX_BUFFER_SIZE)
+message_count = 0  # total entries ever logged; changes whenever message_buffer does
 
-# WebSocket clients
-ws_clients = set()
+# [message_count, json body, gzipped body or None] last served by /api/messages
+_messages_cache = None
+
+# WebSocket clients -> their pending message queue
+ws_clients = {}
 
 # Event loop for websocket
 ws_loop = None
 
+# Open log files (path -> handle), kept open between writes; flushed by log_flusher
+_log_files = {}
+_log_lock = threading.Lock()
+
 
 def log_message(message, log_file=LOG_FILE):
     """Message logging."""
+    global message_count
     try:
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
         log_entry = f"[{timestamp}] {message}"
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(log_entry + "\n")
-        
-        # Add to message buffer
-        message_buffer.append(log_entry)
-        if len(message_buffer) > MAX_BUFFER_SIZE:
-            message_buffer.pop(0)
+        with _log_lock:
+            log_fh = _log_files.get(log_file)
+            if log_fh is None:
+                log_fh = _log_files[log_file] = open(log_file, 'a', buffering=8192, encoding='utf-8')
+            log_fh.write(log_entry + "\n")
+            
+            # Add to message buffer (oldest entry drops off when full)
+            message_buffer.append(log_entry)
+            message_count += 1
         
         # Broadcast to websocket clients
         if ws_loop and ws_clients:
-            asyncio.run_coroutine_threadsafe(
-                broadcast_to_websockets(log_entry), 
-                ws_loop
-            )
+            ws_loop.call_soon_threadsafe(broadcast_to_websockets, log_entry)
     except Exception as e:
         print(f"Error logging: {e}")
 
 
-async def broadcast_to_websockets(message):
-    """Send message to websocket clients."""
-    if ws_clients:
-        disconnected = set()
-        for client in ws_clients:
+def flush_logs():
+    """Write buffered log lines out to disk."""
+    with _log_lock:
+        for log_fh in _log_files.values():
             try:
-                await client.send(message)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected.add(client)
+                log_fh.flush()
             except Exception as e:
-                print(f"WebSocket send error: {e}")
-                disconnected.add(client)
-        
-        # Remove disconnected clients
-        for client in disconnected:
-            ws_clients.discard(client)
+                print(f"Error flushing log: {e}")
+
+
+def log_flusher():
+    """Flush the logs periodically so a busy server batches its writes."""
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        flush_logs()
 
 
-def send_message(channel, *args):
+def messages_json(gzipped=False):
+    """Return the /api/messages body, rebuilt only after new entries; gzip it on first request."""
+    global _messages_cache
+    cache = _messages_cache
+    if cache is None or cache[0] != message_count:
+        count = message_count
+        body = _JSON_ENC.encode({'messages': list(message_buffer)})
+        cache = _messages_cache = [count, body, None]
+    if not gzipped:
+        return cache[1]
+    if cache[2] is None:
+        cache[2] = gzip.compress(cache[1], compresslevel=GZIP_LEVEL)
+    return cache[2]
+
+
+def broadcast_to_websockets(message):
+    """Queue message for every websocket client. Runs on ws_loop."""
+    # Encode once here rather than once per client in send()
+    data = message.encode('utf-8')
+    for client, pending in list(ws_clients.items()):
+        try:
+            pending.put_nowait(data)
+        except asyncio.QueueFull:
+            # Client cannot keep up; drop it instead of buffering without bound
+            print("WebSocket client too slow, disconnecting")
+            del ws_clients[client]
+            asyncio.ensure_future(client.close())
+
+
+async def websocket_writer(client, pending):
+    """Send queued messages to one websocket client."""
+    try:
+        while True:
+            message = await pending.get()
+            # Queued messages are str (history) or UTF-8 bytes; both go out as text frames
+            await client.send(message, text=True)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    except Exception as e:
+        print(f"WebSocket send error: {e}")
+        await client.close()
+
+
+def send_message(channel, message):
+    try:
+        channel.sendall(encode_frame(message))
+        return True
+    except Exception as e:
+        print(f"Error sending: {e}")
+        return False
+
+
+def send_frame(channel, frame):
     try:
-        buffer = pickle.dumps(args)
-        value = socket.htonl(len(buffer))
-        size = struct.pack("L", value)
-        channel.send(size)
-        channel.send(buffer)
+        channel.sendall(frame)
         return True
     except Exception as e:
         print(f"Error sending: {e}")
@@ -96,15 +173,16 @@ def send_message(channel, *args):
 
 def receive_message(channel):
     try:
-        size_data = channel.recv(struct.calcsize("L"))
-        if not size_data:
+        # recv(4) could return a short header, so read it like the body
+        header = bytearray(HEADER.size)
+        if not recv_exact(channel, memoryview(header)):
+            return ''
+        size = HEADER.unpack(header)[0]
+        buf = bytearray(size)
+        if not recv_exact(channel, memoryview(buf)):
             return ''
-        size = socket.ntohl(struct.unpack("L", size_data)[0])
-        buf = b""
-        while len(buf) < size:
-            buf += channel.recv(size - len(buf))
-        return pickle.loads(buf)[0]
-    except:
+        return _DEC.decode(buf)
+    except Exception:
         return ''
 
 
@@ -114,27 +192,27 @@ class RateLimiter:
     def __init__(self, max_messages, time_window):
         self.max_messages = max_messages
         self.time_window = time_window
-        self.message_times = {}
+        self.message_times = {}  # client_id -> deque of timestamps
     
     def check_rate(self, client_id):
         """Check if client is in rate limit."""
         current_time = time.time()
         
-        if client_id not in self.message_times:
-            self.message_times[client_id] = []
+        times = self.message_times.get(client_id)
+        if times is None:
+            times = self.message_times[client_id] = collections.deque()
         
-        # Remove old messages outside the time window
-        self.message_times[client_id] = [
-            t for t in self.message_times[client_id] 
-            if current_time - t < self.time_window
-        ]
+        # Remove old messages outside the time window (oldest first)
+        cutoff = current_time - self.time_window
+        while times and times[0] <= cutoff:
+            times.popleft()
         
         # Check if limit exceeded
-        if len(self.message_times[client_id]) >= self.max_messages:
+        if len(times) >= self.max_messages:
             return False
         
         # Add current message time
-        self.message_times[client_id].append(current_time)
+        times.append(current_time)
         return True
     
     def remove_client(self, client_id):
@@ -153,13 +231,19 @@ class ChatServer:
         self.clients = 0
         self.clientmap = {}  # socket -> (address, nickname)
         self.nickname_map = {}  # nickname -> socket
-        self.outputs = []
+        self._user_list_frame = None  # encoded UserList, reset when nickname_map changes
+        self.outputs = set()  # connected client sockets
+        self.sel = selectors.DefaultSelector()
         self.server = None
         self.running = False
         self.rate_limiter = RateLimiter(MESSAGE_RATE_LIMIT, RATE_LIMIT_WINDOW)
         self.total_messages = 0
         self.private_messages = 0
+        # Guards membership and counters; HTTP and stats threads read them
+        self._state_lock = threading.RLock()
         self.offline_messages = {}  # nickname -> [(sender, message, timestamp)]
+        self._html_parts = self.load_html_template()
+        self.commands = {'/pm': self.handle_pm_command}  # command -> handler(sock, args)
         
         try:
             # Setup chat server
@@ -167,6 +251,7 @@ class ChatServer:
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server.bind((SERVER_HOST, chat_port))
             self.server.listen(backlog)
+            self.sel.register(self.server, selectors.EVENT_READ)
             print(f"Chat Server listening on {SERVER_HOST}:{chat_port}")
             log_message(f"Chat Server started on {SERVER_HOST}:{chat_port}")
             
@@ -178,6 +263,10 @@ class ChatServer:
             self.ws_thread = threading.Thread(target=self.run_websocket_server, daemon=True)
             self.ws_thread.start()
             
+            # Flush the log in the background
+            self.log_thread = threading.Thread(target=log_flusher, daemon=True)
+            self.log_thread.start()
+            
             signal.signal(signal.SIGINT, self.shutdown)
         except Exception as e:
             print(f"Error starting server: {e}")
@@ -186,7 +275,7 @@ class ChatServer:
     def run_http_server(self):
         try:
             handler = self.http_handler()
-            httpd = HTTPServer((SERVER_HOST, self.http_port), handler)
+            httpd = ThreadingHTTPServer((SERVER_HOST, self.http_port), handler)
             print(f"HTTP Server listening on {SERVER_HOST}:{self.http_port}")
             log_message(f"HTTP Server started on {SERVER_HOST}:{self.http_port}")
             httpd.serve_forever()
@@ -198,15 +287,17 @@ class ChatServer:
         global ws_loop
         
         async def handler(websocket):
-            # Add client to set
-            ws_clients.add(websocket)
+            # Queue existing messages (snapshot: the chat thread keeps appending)
+            pending = asyncio.Queue(WS_QUEUE_SIZE)
+            for msg in list(message_buffer):
+                pending.put_nowait(msg)
+            
+            # Add client; it gets every message logged from here on
+            ws_clients[websocket] = pending
             print(f"WebSocket client connected. Total: {len(ws_clients)}")
+            writer = asyncio.create_task(websocket_writer(websocket, pending))
             
             try:
-                # Send existing messages
-                for msg in message_buffer:
-                    await websocket.send(msg)
-                
                 # Keep connection alive
                 await websocket.wait_closed()
             except websockets.exceptions.ConnectionClosed:
@@ -214,18 +305,20 @@ class ChatServer:
             except Exception as e:
                 print(f"WebSocket handler error: {e}")
             finally:
-                ws_clients.discard(websocket)
+                writer.cancel()
+                ws_clients.pop(websocket, None)
                 print(f"WebSocket client disconnected. Total: {len(ws_clients)}")
         
         async def start_server():
-            async with websockets.serve(handler, SERVER_HOST, self.ws_port):
+            # Chat lines are tiny; per-message deflate would only cost CPU
+            async with websockets.serve(handler, SERVER_HOST, self.ws_port, compression=None):
                 print(f"WebSocket Server listening on {SERVER_HOST}:{self.ws_port}")
                 log_message(f"WebSocket Server started on {SERVER_HOST}:{self.ws_port}")
                 await asyncio.Future()  # run forever
         
         try:
             # Create and set the event loop for this thread
-            ws_loop = asyncio.new_event_loop()
+            ws_loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
             asyncio.set_event_loop(ws_loop)
             ws_loop.run_until_complete(start_server())
         except Exception as e:
@@ -236,39 +329,49 @@ class ChatServer:
         server_ref = self
         
         class ChatHTTPHandler(SimpleHTTPRequestHandler):
+            # HTTP/1.1 keeps monitor connections open between polls
+            protocol_version = 'HTTP/1.1'
+            
             def do_GET(self):
                 if self.path == '/':
-                    self.send_response(200)
-                    self.send_header('Content-type', 'text/html')
-                    self.end_headers()
                     html = server_ref.generate_html()
-                    self.wfile.write(html.encode())
+                    self.send_body(html.encode(), 'text/html')
                 elif self.path == '/api/messages':
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    data = json.dumps({'messages': message_buffer})
-                    self.wfile.write(data.encode())
+                    if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                        self.send_body(messages_json(gzipped=True), 'application/json',
+                                       'gzip', negotiated=True)
+                    else:
+                        self.send_body(messages_json(), 'application/json', negotiated=True)
                 elif self.path == '/api/stats':
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
+                    clients, total_messages, private_messages = server_ref.stats_snapshot()
                     stats = {
-                        'clients': server_ref.clients,
-                        'total_messages': server_ref.total_messages,
-                        'private_messages': server_ref.private_messages
+                        'clients': clients,
+                        'total_messages': total_messages,
+                        'private_messages': private_messages
                     }
-                    self.wfile.write(json.dumps(stats).encode())
+                    self.send_body(_JSON_ENC.encode(stats), 'application/json')
                 else:
                     self.send_error(404)
             
+            def send_body(self, body, content_type, encoding=None, negotiated=False):
+                self.send_response(200)
+                self.send_header('Content-type', content_type)
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                if negotiated:
+                    # Body depends on Accept-Encoding; keep shared caches from mixing them up
+                    self.send_header('Vary', 'Accept-Encoding')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
             def log_message(self, format, *args):
                 pass  # Suppress HTTP logs
         
         return ChatHTTPHandler
     
-    def generate_html(self):
-        """Generate HTML for web page."""
+    def load_html_template(self):
+        """Read the web page template once, split around the live counters."""
         try:
             # Get the directory where the script is located
             script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -278,22 +381,37 @@ class ChatServer:
             with open(html_file_path, 'r', encoding='utf-8') as f:
                 html_template = f.read()
             
-            # Replace placeholders with actual values
-            html_content = html_template.replace('{{CLIENT_COUNT}}', str(self.clients))
-            html_content = html_content.replace('{{MESSAGE_COUNT}}', str(self.total_messages))
-            html_content = html_content.replace('{{PRIVATE_COUNT}}', str(self.private_messages))
-            html_content = html_content.replace('{{WS_PORT}}', str(self.ws_port))
+            # The WebSocket port never changes, so fill it in now
+            html_template = html_template.replace('{{WS_PORT}}', str(self.ws_port))
             
-            return html_content
+            # Text segments at even indices, placeholders at odd ones
+            return HTML_PLACEHOLDERS.split(html_template)
         except FileNotFoundError:
-            return "<html><body><h1>Error: chat_monitor.html not found</h1></body></html>"
+            return ["<html><body><h1>Error: chat_monitor.html not found</h1></body></html>"]
         except Exception as e:
-            return f"<html><body><h1>Error loading HTML: {e}</h1></body></html>"
+            return [f"<html><body><h1>Error loading HTML: {e}</h1></body></html>"]
+    
+    def generate_html(self):
+        """Generate HTML for web page."""
+        clients, total_messages, private_messages = self.stats_snapshot()
+        values = {
+            '{{CLIENT_COUNT}}': str(clients),
+            '{{MESSAGE_COUNT}}': str(total_messages),
+            '{{PRIVATE_COUNT}}': str(private_messages),
+        }
+        parts = self._html_parts
+        return ''.join([values[part] if i % 2 else part for i, part in enumerate(parts)])
     
     def shutdown(self, signum=None, frame=None):
-        """Clean shutdown."""
+        """SIGINT handler: unwind the main loop, which then calls close()."""
+        # Raise rather than only set the flag: a blocking recv is resumed after
+        # the handler returns (PEP 475). Unwinding also releases _log_lock.
         print("\nShutting down server...")
         self.running = False
+        raise KeyboardInterrupt
+    
+    def close(self):
+        """Clean shutdown."""
         for output in self.outputs:
             try:
                 output.close()
@@ -304,7 +422,9 @@ class ChatServer:
                 self.server.close()
             except:
                 pass
+        self.sel.close()
         log_message("Server shut down")
+        flush_logs()
         sys.exit(0)
     
     def generate_unique_nickname(self, base_nickname):
@@ -328,9 +448,13 @@ class ChatServer:
     
     def broadcast(self, message, exclude=None):
         """Send message to all clients."""
+        self._broadcast_frame(encode_frame(Public(message)), exclude)
+    
+    def _broadcast_frame(self, frame, exclude=None):
+        """Send one encoded frame to all clients."""
         for output in self.outputs:
-            if output != exclude:
-                send_message(output, message)
+            if output is not exclude:
+                send_frame(output, frame)
     
     def send_private_message(self, sender_sock, target_nickname, message):
         """Send private message to target user."""
@@ -340,11 +464,13 @@ class ChatServer:
         if target_nickname in self.nickname_map:
             target_sock = self.nickname_map[target_nickname]
             pm_msg = f"[{timestamp}] PRIVATE from {sender_name}: {message}"
-            send_message(target_sock, pm_msg)
-            send_message(sender_sock, f"[{timestamp}] PRIVATE to {target_nickname}: {message}")
+            send_message(target_sock, PrivateIn(sender_name, pm_msg))
+            send_message(sender_sock, PrivateOut(
+                target_nickname, f"[{timestamp}] PRIVATE to {target_nickname}: {message}"))
             
             log_message(f"PRIVATE [{sender_name} -> {target_nickname}]: {message}")
-            self.private_messages += 1
+            with self._state_lock:
+                self.private_messages += 1
             return True
         else:
             # User offline - save message
@@ -352,7 +478,7 @@ class ChatServer:
                 self.offline_messages[target_nickname] = []
             self.offline_messages[target_nickname].append((sender_name, message, timestamp))
             
-            send_message(sender_sock, f"User {target_nickname} is offline. Message saved for delivery.")
+            send_message(sender_sock, OfflineMessage(f"User {target_nickname} is offline. Message saved for delivery."))
             log_message(f"OFFLINE MESSAGE [{sender_name} -> {target_nickname}]: {message}")
             return False
     
@@ -362,19 +488,19 @@ class ChatServer:
             messages = self.offline_messages[nickname]
             for sender, msg, timestamp in messages:
                 pm_msg = f"[{timestamp}] OFFLINE MESSAGE from {sender}: {msg}"
-                send_message(client_sock, pm_msg)
+                send_message(client_sock, OfflineMessage(pm_msg))
             del self.offline_messages[nickname]
             log_message(f"Delivered {len(messages)} offline messages to {nickname}")
     
     def send_user_list(self, client_sock):
         """Send list of connected users to client."""
-        user_list = list(self.nickname_map.keys())
-        send_message(client_sock, f"USERLIST:{','.join(user_list)}")
+        frame = self._user_list_frame
+        if frame is None:
+            frame = self._user_list_frame = encode_frame(UserList(sorted(self.nickname_map)))
+        send_frame(client_sock, frame)
     
     def run(self):
         """Main server loop."""
-        inputs = [self.server]
-        self.outputs = []
         self.running = True
         
         print("Server running. Press Ctrl+C to stop.\n")
@@ -384,37 +510,47 @@ class ChatServer:
         stats_thread = threading.Thread(target=self.print_stats, daemon=True)
         stats_thread.start()
         
-        while self.running:
-            try:
-                readable, writeable, exceptional = select.select(inputs, self.outputs, inputs, 1)
-            except select.error as e:
-                print(f"Select error: {e}")
-                break
-            
-            for sock in readable:
-                if sock == self.server:
-                    self.handle_new_connection(inputs)
-                else:
-                    self.handle_client_message(sock, inputs)
-            
-            for sock in exceptional:
-                self.handle_client_error(sock, inputs)
+        try:
+            while self.running:
+                try:
+                    events = self.sel.select(timeout=1)
+                except OSError as e:
+                    print(f"Select error: {e}")
+                    break
+                
+                # Only sockets with pending data come back; errors show up as a failed read
+                for key, mask in events:
+                    if key.fileobj is self.server:
+                        self.handle_new_connection()
+                    else:
+                        self.handle_client_message(key.fileobj)
+        except KeyboardInterrupt:
+            pass
+        
+        self.close()
+    
+    def stats_snapshot(self):
+        """Return (connected clients, total messages, private messages)."""
+        with self._state_lock:
+            return self.clients, self.total_messages, self.private_messages
     
     def print_stats(self):
         """Print periodic stats."""
         while self.running:
             time.sleep(30)
+            clients, total_messages, private_messages = self.stats_snapshot()
             print(f"\n=== Server Stats ===")
-            print(f"Connected Clients: {self.clients}")
-            print(f"Total Messages: {self.total_messages}")
-            print(f"Private Messages: {self.private_messages}")
+            print(f"Connected Clients: {clients}")
+            print(f"Total Messages: {total_messages}")
+            print(f"Private Messages: {private_messages}")
             print(f"WebSocket Clients: {len(ws_clients)}")
             print(f"==================\n")
     
-    def handle_new_connection(self, inputs):
+    def handle_new_connection(self):
         """Accept new client."""
         try:
             client, address = self.server.accept()
+            tune_socket(client, quickack=True)
             print(f"New connection from {address}")
             
             cname = receive_message(client)
@@ -427,7 +563,7 @@ class ChatServer:
             # Block nicknames starting with '*' (reserved for relay)
             if cname.startswith('*'):
                 error_msg = "Nickname cannot start with '*' (reserved for relay)"
-                send_message(client, f"ERROR: {error_msg}")
+                send_message(client, Error(f"ERROR: {error_msg}"))
                 log_message(f"Connection rejected from {address}: {error_msg}")
                 client.close()
                 return
@@ -436,13 +572,15 @@ class ChatServer:
             original_name = cname
             cname = self.generate_unique_nickname(cname)
             
-            self.clients += 1
-            self.clientmap[client] = (address, cname)
-            self.nickname_map[cname] = client
-            inputs.append(client)
-            self.outputs.append(client)
+            with self._state_lock:
+                self.clients += 1
+                self.clientmap[client] = (address, cname)
+                self.nickname_map[cname] = client
+                self._user_list_frame = None
+                self.sel.register(client, selectors.EVENT_READ)
+                self.outputs.add(client)
             
-            send_message(client, f'CLIENT: {cname}')
+            send_message(client, ClientName(cname))
             
             # Send user list
             self.send_user_list(client)
@@ -455,14 +593,13 @@ class ChatServer:
             log_message(join_msg)
             self.broadcast(join_msg, exclude=client)
             
-            # update user list
-            for sock in self.outputs:
-                self.send_user_list(sock)
+            # Others patch their user list; the new client already has the full list
+            self._broadcast_frame(encode_frame(UserJoin(cname)), exclude=client)
             
         except Exception as e:
             print(f"Error accepting connection: {e}")
     
-    def handle_client_message(self, sock, inputs):
+    def handle_client_message(self, sock):
         try:
             data = receive_message(sock)
             
@@ -471,20 +608,17 @@ class ChatServer:
                 
                 # Check rate limit
                 if not self.rate_limiter.check_rate(client_name):
-                    send_message(sock, "RATE_LIMIT: You are sending messages too quickly. Slow down!")
+                    send_message(sock, RateLimited("RATE_LIMIT: You are sending messages too quickly. Slow down!"))
                     log_message(f"Rate limit triggered for {client_name}")
                     return
                 
-                # Handle private message
-                if data.startswith('/pm '):
-                    parts = data.split(' ', 2)
-                    if len(parts) >= 3:
-                        target = parts[1]
-                        message = parts[2]
-                        self.send_private_message(sock, target, message)
-                    else:
-                        send_message(sock, "Usage: /pm <nickname> <message>")
-                    return
+                # Handle commands
+                if data[:1] == '/':
+                    sp = data.find(' ')
+                    handler = self.commands.get(data[:sp] if sp > 0 else data)
+                    if handler:
+                        handler(sock, data[sp + 1:] if sp > 0 else '')
+                        return
                 
                 # Broadcast public message
                 timestamp = datetime.datetime.now().strftime('%H:%M:%S')
@@ -492,32 +626,44 @@ class ChatServer:
                 print(msg)
                 log_message(msg)
                 self.broadcast(msg, exclude=sock)
-                self.total_messages += 1
+                with self._state_lock:
+                    self.total_messages += 1
             else:
-                self.handle_client_disconnect(sock, inputs)
+                self.handle_client_disconnect(sock)
         except Exception as e:
             print(f"Error handling message: {e}")
-            self.handle_client_disconnect(sock, inputs)
+            self.handle_client_disconnect(sock)
+    
+    def handle_pm_command(self, sock, args):
+        """/pm <nickname> <message>"""
+        parts = args.split(' ', 1)
+        if len(parts) == 2:
+            self.send_private_message(sock, parts[0], parts[1])
+        else:
+            send_message(sock, Error("Usage: /pm <nickname> <message>"))
     
-    def handle_client_disconnect(self, sock, inputs):
+    def handle_client_disconnect(self, sock):
         client_name = self.get_client_name(sock)
         print(f"{client_name} disconnected")
         
-        self.clients -= 1
-        if sock in inputs:
-            inputs.remove(sock)
-        if sock in self.outputs:
-            self.outputs.remove(sock)
-        if sock in self.clientmap:
-            del self.clientmap[sock]
-        if client_name in self.nickname_map:
-            del self.nickname_map[client_name]
+        with self._state_lock:
+            self.clients -= 1
+            try:
+                self.sel.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            self.outputs.discard(sock)
+            if sock in self.clientmap:
+                del self.clientmap[sock]
+            if client_name in self.nickname_map:
+                del self.nickname_map[client_name]
+                self._user_list_frame = None
         
         self.rate_limiter.remove_client(client_name)
         
         try:
             sock.close()
-        except:
+        except Exception:
             pass
         
         leave_msg = f"{client_name} left (Total Clients: {self.clients})"
@@ -525,16 +671,8 @@ class ChatServer:
         log_message(leave_msg)
         self.broadcast(leave_msg)
         
-        # Update all clients with new user list
-        for sock in self.outputs:
-            self.send_user_list(sock)
-    
-    def handle_client_error(self, sock, inputs):
-        if sock == self.server:
-            print("Server socket error")
-            self.shutdown()
-        else:
-            self.handle_client_disconnect(sock, inputs)
+        # Update all clients' user list
+        self._broadcast_frame(encode_frame(UserLeave(client_name)))
 
 
 def main():
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Chat Protocol - message schemas and framing helpers shared by server, client and relay"""
+
+import socket
+import struct
+from typing import List, Union
+import msgspec
+
+# Every frame is a 4-byte unsigned length in network byte order, then the msgpack payload
+HEADER = struct.Struct("!I")
+
+_ENC = msgspec.msgpack.Encoder()
+
+# Client -> server messages are plain strings ("NAME: x", "/pm x text", chat lines).
+# Server -> client messages are tagged arrays [tag, *fields], one Struct per tag.
+
+
+class ClientName(msgspec.Struct, tag='cl', array_like=True):
+    """Assigned nickname after NAME."""
+    nickname: str
+
+
+class UserList(msgspec.Struct, tag='ul', array_like=True):
+    """Connected user list."""
+    users: List[str]
+
+
+class UserJoin(msgspec.Struct, tag='uj', array_like=True):
+    """A user joined; patch the last user list."""
+    nickname: str
+
+
+class UserLeave(msgspec.Struct, tag='uq', array_like=True):
+    """A user left; patch the last user list."""
+    nickname: str
+
+
+class PrivateIn(msgspec.Struct, tag='pi', array_like=True):
+    """Incoming private message."""
+    sender: str
+    text: str
+
+
+class PrivateOut(msgspec.Struct, tag='po', array_like=True):
+    """Echo of a sent private message."""
+    target: str
+    text: str
+
+
+class OfflineMessage(msgspec.Struct, tag='om', array_like=True):
+    """Offline message or offline notice."""
+    text: str
+
+
+class RateLimited(msgspec.Struct, tag='rl', array_like=True):
+    """Rate limit warning."""
+    text: str
+
+
+class Error(msgspec.Struct, tag='er', array_like=True):
+    """Error / usage notice."""
+    text: str
+
+
+class Public(msgspec.Struct, tag='pub', array_like=True):
+    """Public chat and join/leave lines."""
+    text: str
+
+
+ServerMessage = Union[ClientName, UserList, UserJoin, UserLeave, PrivateIn, PrivateOut,
+                      OfflineMessage, RateLimited, Error, Public]
+
+# Anything that can appear on a chat connection, in either direction
+Message = Union[str, ServerMessage]
+
+
+def tune_socket(sock, quickack=False):
+    """Disable Nagle and enable keepalive on a chat connection."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Linux only, and the kernel may drop back to delayed ACKs later
+    if quickack and hasattr(socket, 'TCP_QUICKACK'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+
+def encode_frame(message):
+    """Serialize message into a length-prefixed frame."""
+    buffer = _ENC.encode(message)
+    return HEADER.pack(len(buffer)) + buffer
+
+
+def recv_exact(channel, view, flags=0):
+    """Fill view from channel; False if the peer closed first."""
+    size = len(view)
+    off = 0
+    while off < size:
+        n = channel.recv_into(view[off:], size - off, flags)
+        if not n:
+            return False
+        off += n
+    return True